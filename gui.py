@@ -1,13 +1,17 @@
+import bisect
 import csv
 import ctypes
+import functools
 import re
 import os
 import pathlib
 
+import ahocorasick
 from PyQt5.QtWidgets import (
     QApplication,
     QMainWindow,
     QTableView,
+    QHeaderView,
     QVBoxLayout,
     QWidget,
     QHBoxLayout,
@@ -32,18 +36,31 @@ from PyQt5.QtGui import (
     QIcon,
     QSyntaxHighlighter,
     QTextCharFormat,
+    QTextCursor,
     QColor,
     QFont,
 )
 
-from PyQt5.QtCore import Qt, QAbstractTableModel, QVariant, QThread, pyqtSignal, QRegExp
+from PyQt5.QtCore import (
+    Qt,
+    QAbstractTableModel,
+    QModelIndex,
+    QThread,
+    QTimer,
+    pyqtSignal,
+)
 
 MY_APP_ID = "emblem_team.gui.fe3h.1"
+FILTER_DELAY_MS = 150
+READ_BUFFER_SIZE = 1 << 20
+LOAD_BATCH_SIZE = 5000
+ROW_PADDING = 8
 
 HEADERS = ["Index", "Type", "Source", "Translate"]
 RAW_HEADERS = ["file_index", "file_type", "source_language", "destination_language"]
 
 
+@functools.lru_cache(maxsize=1)
 def get_glossary() -> list[tuple[str, str]]:
     glossary: list[tuple[str, str]] = []
     glossary_pattern = re.compile(r"- (.*?) - \*{0,2}(.*?)\*{0,2}$")
@@ -57,33 +74,68 @@ def get_glossary() -> list[tuple[str, str]]:
     return glossary
 
 
+def build_automaton(glossary: list[tuple[str, str]]) -> ahocorasick.Automaton:
+    automaton = ahocorasick.Automaton()
+    for en_term, _ in glossary:
+        automaton.add_word(en_term.lower(), en_term)
+    if len(automaton):
+        automaton.make_automaton()
+    return automaton
+
+
+@functools.lru_cache(maxsize=1)
+def get_glossary_automaton() -> ahocorasick.Automaton:
+    return build_automaton(get_glossary())
+
+
+def find_glossary_runs(
+    automaton: ahocorasick.Automaton, text: str
+) -> tuple[list[tuple[int, int]], set[str]]:
+    terms = set()
+    if not text or not len(automaton):
+        return [], terms
+    spans = []
+    for end, term in automaton.iter(text.lower()):
+        spans.append((end - len(term) + 1, end + 1))
+        terms.add(term)
+    spans.sort()
+    # Merge overlapping matches ("Black Eagles" / "Eagles") so each
+    # highlighted run is formatted once.
+    runs = []
+    run_start = run_end = -1
+    for start, end in spans:
+        if start > run_end:
+            if run_end > run_start:
+                runs.append((run_start, run_end - run_start))
+            run_start = start
+        run_end = max(run_end, end)
+    if run_end > run_start:
+        runs.append((run_start, run_end - run_start))
+    return runs, terms
+
+
+def glossary_format() -> QTextCharFormat:
+    fmt = QTextCharFormat()
+    fmt.setForeground(QColor("darkred"))
+    fmt.setFontWeight(QFont.Bold)
+    return fmt
+
+
 class GlossaryHighlighter(QSyntaxHighlighter):
     def __init__(
-        self, document, glossary: list[tuple[str, str]], on_found_terms_changed
+        self, document, automaton: ahocorasick.Automaton, on_found_terms_changed
     ):
         super().__init__(document)
-        self.glossary = glossary
+        self.automaton = automaton
         self.on_found_terms_changed = on_found_terms_changed
         self.found_terms = set()
-
-        self.fmt = QTextCharFormat()
-        self.fmt.setForeground(QColor("darkred"))
-        self.fmt.setFontWeight(QFont.Bold)
-
-        self.rules = []
-        for name, _ in glossary:
-            escaped = re.escape(name)
-            pattern = QRegExp(escaped, re.IGNORECASE)
-            self.rules.append((name, pattern))
+        self.fmt = glossary_format()
 
     def highlightBlock(self, text):
-        for term, pattern in self.rules:
-            index = pattern.indexIn(text)
-            while index >= 0:
-                length = pattern.matchedLength()
-                self.setFormat(index, length, self.fmt)
-                self.found_terms.add(term)
-                index = pattern.indexIn(text, index + length)
+        runs, terms = find_glossary_runs(self.automaton, text)
+        for start, length in runs:
+            self.setFormat(start, length, self.fmt)
+        self.found_terms.update(terms)
 
     def rehighlight(self):
         self.found_terms.clear()
@@ -99,19 +151,46 @@ class CSVLoaderThread(QThread):
         self.file_path = file_path
 
     def run(self):
-        with open(self.file_path, newline="", encoding="utf-8") as f:
+        with open(
+            self.file_path, newline="", encoding="utf-8", buffering=READ_BUFFER_SIZE
+        ) as f:
             reader = csv.reader(f)
-            data = list(reader)
-        rows = data[1:]
+            next(reader, None)  # skip raw headers
+            rows = list(reader)
         self.loaded.emit(HEADERS, rows)
 
 
+class CSVSaverThread(QThread):
+    saved = pyqtSignal()
+
+    def __init__(self, file_path, headers, rows):
+        super().__init__()
+        self.file_path = file_path
+        self.headers = headers
+        self.rows = rows
+
+    def run(self):
+        with open(self.file_path, "w", newline="", encoding="utf-8") as f:
+            writer = csv.writer(f)
+            writer.writerow(self.headers)
+            writer.writerows(self.rows)
+        self.saved.emit()
+
+
 class CSVTableModel(QAbstractTableModel):
     def __init__(self, headers, data):
         super().__init__()
         self.headers = headers
-        self.original_data = data
-        self.filtered_data = data
+        self.original_data = []
+        # Filtered rows are the same list objects as in original_data, so an
+        # edit through either one is visible in both.
+        self.filtered_data = []
+        self.filtered_indices = []
+        self._lc = []
+        self._untranslated = 0
+        self._last_filter = ("", "", False)
+        self._row_labels = []
+        self.append_rows(data)
 
     def rowCount(self, parent=None):
         return len(self.filtered_data)
@@ -119,29 +198,43 @@ class CSVTableModel(QAbstractTableModel):
     def columnCount(self, parent=None):
         return len(self.headers)
 
-    def data(self, index, role=Qt.DisplayRole):
-        if not index.isValid():
-            return QVariant()
-        if role == Qt.DisplayRole:
-            return self.filtered_data[index.row()][index.column()]
-        return QVariant()
+    # Qt.DisplayRole is bound as a default so the hot path skips the global
+    # and attribute lookup on every call.
+    def data(self, index, role=Qt.DisplayRole, _display_role=Qt.DisplayRole):
+        if role != _display_role or not index.isValid():
+            return None
+        return self.filtered_data[index.row()][index.column()]
 
     def headerData(self, section, orientation, role=Qt.DisplayRole):
-        if role == Qt.DisplayRole:
-            if orientation == Qt.Horizontal:
-                return self.headers[section]
-            else:
-                return str(section + 1)
-        return QVariant()
+        if role != Qt.DisplayRole:
+            return None
+        if orientation == Qt.Horizontal:
+            return self.headers[section]
+        labels = self._row_labels
+        if section >= len(labels):
+            labels.extend(str(i + 1) for i in range(len(labels), section + 1))
+        return labels[section]
 
     def get_row(self, row):
         return self.filtered_data[row]
 
-    def set_translation(self, row, new_value):
-        index_in_original = self.original_data.index(self.filtered_data[row])
-        self.original_data[index_in_original][3] = new_value
-        self.filtered_data[row][3] = new_value
-        self.dataChanged.emit(self.index(row, 3), self.index(row, 3))
+    def original_index(self, row):
+        return self.filtered_indices[row]
+
+    def set_translation(self, orig_idx, new_value):
+        old_value = self.original_data[orig_idx][3]
+        if old_value == "" and new_value != "":
+            self._untranslated -= 1
+        elif old_value != "" and new_value == "":
+            self._untranslated += 1
+        self.original_data[orig_idx][3] = new_value
+        file_type, source, _ = self._lc[orig_idx]
+        self._lc[orig_idx] = (file_type, source, new_value.lower())
+        # filtered_indices is ascending, so the visible row (if any) can be
+        # found by bisection.
+        row = bisect.bisect_left(self.filtered_indices, orig_idx)
+        if row < len(self.filtered_indices) and self.filtered_indices[row] == orig_idx:
+            self.dataChanged.emit(self.index(row, 3), self.index(row, 3))
 
     def apply_filter(
         self, text_filter="", file_type_filter="", show_untranslated=False
@@ -149,25 +242,70 @@ class CSVTableModel(QAbstractTableModel):
         text_filter = text_filter.lower()
         file_type_filter = file_type_filter.lower()
 
-        def match(row):
-            file_type = row[1].lower()
-            source = row[2].lower()
-            dest = row[3].lower()
-            untranslated = dest == ""
-
-            return (
-                (not show_untranslated or untranslated)
-                and (text_filter in source or text_filter in dest)
-                and (file_type_filter in file_type)
-            )
-
-        self.beginResetModel()
-        self.filtered_data = [row for row in self.original_data if match(row)]
-        self.endResetModel()
+        # A longer search text can only drop rows, so rescan the current
+        # result instead of the whole dataset when nothing else changed.
+        last_text, last_type, last_untranslated = self._last_filter
+        if (
+            last_text in text_filter
+            and last_type == file_type_filter
+            and last_untranslated == show_untranslated
+        ):
+            candidates = self.filtered_indices
+        else:
+            candidates = range(len(self.original_data))
+        self._last_filter = (text_filter, file_type_filter, show_untranslated)
+
+        self.set_filtered(self.match(candidates))
+
+    def match(self, candidates):
+        text_filter, file_type_filter, show_untranslated = self._last_filter
+        lc = self._lc
+        data = self.original_data
+        return [
+            i
+            for i in candidates
+            if (not show_untranslated or data[i][3] == "")
+            and (text_filter in lc[i][1] or text_filter in lc[i][2])
+            and file_type_filter in lc[i][0]
+        ]
+
+    def append_rows(self, rows):
+        start = len(self.original_data)
+        self.original_data.extend(rows)
+        self._lc.extend((r[1].lower(), r[2].lower(), r[3].lower()) for r in rows)
+        self._untranslated += sum(1 for r in rows if r[3] == "")
+        indices = self.match(range(start, len(self.original_data)))
+        if not indices:
+            return
+        first = len(self.filtered_indices)
+        self.beginInsertRows(QModelIndex(), first, first + len(indices) - 1)
+        self.filtered_indices.extend(indices)
+        self.filtered_data.extend(self.original_data[i] for i in indices)
+        self.endInsertRows()
+
+    def set_filtered(self, indices):
+        # layoutChanged keeps selection and scroll position, unlike a reset.
+        # Persistent indexes are moved to the new row of the same original
+        # row, or invalidated if that row was filtered out.
+        self.layoutAboutToBeChanged.emit()
+        old_persistent = self.persistentIndexList()
+        old_indices = self.filtered_indices
+        self.filtered_indices = indices
+        self.filtered_data = [self.original_data[i] for i in indices]
+        new_rows = {orig: row for row, orig in enumerate(indices)}
+        new_persistent = []
+        for index in old_persistent:
+            row = new_rows.get(old_indices[index.row()])
+            if row is None:
+                new_persistent.append(QModelIndex())
+            else:
+                new_persistent.append(self.index(row, index.column()))
+        self.changePersistentIndexList(old_persistent, new_persistent)
+        self.layoutChanged.emit()
 
     def stats(self):
         total = len(self.original_data)
-        untranslated = sum(1 for r in self.original_data if r[3] == "")
+        untranslated = self._untranslated
         percent = int((total - untranslated) / total * 100) if total > 0 else 0
         return total, untranslated, percent
 
@@ -179,17 +317,15 @@ class EditDialog(QDialog):
         self.resize(1200, 400)
 
         self.glossary = get_glossary()
+        self.glossary_automaton = get_glossary_automaton()
 
         self.original_text = QTextEdit(self)
-        self.original_light = GlossaryHighlighter(
-            self.original_text.document(), self.glossary, self.update_list
-        )
         self.original_text.setPlainText(original_text)
         self.original_text.setReadOnly(True)
 
         self.translated_text = QTextEdit(self)
         self.translated_light = GlossaryHighlighter(
-            self.translated_text.document(), self.glossary, self.update_list
+            self.translated_text.document(), self.glossary_automaton, self.update_list
         )
         self.translated_text.setPlainText(translated_text)
 
@@ -229,7 +365,21 @@ class EditDialog(QDialog):
         def_lay.addLayout(self.glossary_layout)
         self.setLayout(def_lay)
 
-        self.original_light.rehighlight()
+        self.highlight_original()
+
+    def highlight_original(self):
+        # The source text is read-only, so format it once instead of keeping
+        # a live highlighter attached to its document.
+        runs, terms = find_glossary_runs(
+            self.glossary_automaton, self.original_text.toPlainText()
+        )
+        fmt = glossary_format()
+        cursor = QTextCursor(self.original_text.document())
+        for start, length in runs:
+            cursor.setPosition(start)
+            cursor.setPosition(start + length, QTextCursor.KeepAnchor)
+            cursor.mergeCharFormat(fmt)
+        self.update_list(sorted(terms))
 
     def on_glossary_clicked(self, item):
         text = item.text()
@@ -264,6 +414,9 @@ class CSVEditor(QMainWindow):
 
         self.window_icon = QIcon("icon.png")
         self.model = None
+        self.saver_thread = None
+        self.pending_rows = None
+        self.pending_start = 0
         self.filter_data = []
         self.can_save = False
         self.current_file = None
@@ -275,14 +428,19 @@ class CSVEditor(QMainWindow):
         self.setWindowIcon(self.window_icon)
         self.resize(1280, 600)
 
+        self.filter_timer = QTimer(self)
+        self.filter_timer.setSingleShot(True)
+        self.filter_timer.setInterval(FILTER_DELAY_MS)
+        self.filter_timer.timeout.connect(self.apply_filter)
+
         self.search_line_edit = QLineEdit()
         self.search_line_edit.setPlaceholderText("Search...")
-        self.search_line_edit.textChanged.connect(self.apply_filter)
+        self.search_line_edit.textChanged.connect(self.schedule_filter)
         self.search_line_edit.setEnabled(False)
 
         self.file_type_filter = QComboBox()
         self.file_type_filter.setFixedWidth(100)
-        self.file_type_filter.currentTextChanged.connect(self.apply_filter)
+        self.file_type_filter.currentTextChanged.connect(self.schedule_filter)
         self.file_type_filter.setEnabled(False)
 
         self.show_untranslated_checkbox = QCheckBox("Show untranslated")
@@ -328,6 +486,11 @@ class CSVEditor(QMainWindow):
         top_layout.addLayout(filters)
 
         self.table = QTableView()
+        self.table.setWordWrap(False)
+        self.table.verticalHeader().setSectionResizeMode(QHeaderView.Fixed)
+        self.table.verticalHeader().setDefaultSectionSize(
+            self.table.fontMetrics().height() + ROW_PADDING
+        )
         self.table.doubleClicked.connect(self.edit_translation)
 
         shortcut = QShortcut(QKeySequence("Ctrl+F"), self)
@@ -371,22 +534,27 @@ class CSVEditor(QMainWindow):
 
             if reply == QMessageBox.Yes:
                 self.save_csv()
+                self.wait_saved()
         self.current_file = file_path
         self.thread = CSVLoaderThread(file_path)
         self.thread.loaded.connect(self.on_csv_loaded)
         self.thread.start()
 
     def on_csv_loaded(self, headers, rows):
-        self.save_action.setEnabled(True)
+        self.save_action.setEnabled(False)
         self.setWindowTitle(f"Bundle Editor - {self.current_file}")
         self.show_untranslated_checkbox.setEnabled(True)
         self.search_line_edit.setEnabled(True)
-        self.file_type_filter.clear()
         self.filter_data = self.calc_filter_data(rows)
+        # The model is filtered once below; don't queue extra passes while
+        # the type list is rebuilt.
+        self.file_type_filter.blockSignals(True)
+        self.file_type_filter.clear()
         self.file_type_filter.addItems(self.filter_data)
-        self.file_type_filter.setEnabled(True)
         self.file_type_filter.setCurrentIndex(0)
-        self.model = CSVTableModel(headers, rows)
+        self.file_type_filter.blockSignals(False)
+        self.file_type_filter.setEnabled(True)
+        self.model = CSVTableModel(headers, [])
         self.table.setModel(self.model)
         self.table.setColumnWidth(0, 80)
         self.table.setColumnWidth(1, 100)
@@ -395,15 +563,41 @@ class CSVEditor(QMainWindow):
         self.apply_filter()
         self.can_save = False
         self.recent_file_path.write_bytes(self.current_file.encode("utf-8"))
+        self.pending_rows = rows
+        self.pending_start = 0
+        self.populate_model()
+
+    def populate_model(self):
+        # Feed rows in batches, returning to the event loop in between, so
+        # large bundles don't freeze the window while they are added.
+        if self.pending_rows is None:
+            return
+        end = self.pending_start + LOAD_BATCH_SIZE
+        self.model.append_rows(self.pending_rows[self.pending_start : end])
+        self.pending_start = end
+        if end < len(self.pending_rows):
+            QTimer.singleShot(0, self.populate_model)
+        else:
+            self.pending_rows = None
+            self.save_action.setEnabled(True)
+        self.update_stats()
+
+    def finish_populate(self):
+        if self.pending_rows is None:
+            return
+        self.model.append_rows(self.pending_rows[self.pending_start :])
+        self.pending_rows = None
+        self.save_action.setEnabled(True)
+        self.update_stats()
 
     def calc_filter_data(self, rows):
-        unique = ["ALL"]
-        for row in rows:
-            if row[1] not in unique:
-                unique.append(row[1])
-        return unique
+        return ["ALL"] + list(dict.fromkeys(row[1] for row in rows))
+
+    def schedule_filter(self):
+        self.filter_timer.start()
 
     def apply_filter(self):
+        self.filter_timer.stop()
         if not self.model:
             return
         filter_type = self.file_type_filter.currentText()
@@ -427,28 +621,43 @@ class CSVEditor(QMainWindow):
     def edit_translation(self, index):
         if not self.model:
             return
+        model = self.model
         row = index.row()
-        data = self.model.get_row(row)
+        # exec_() runs a nested event loop where a pending filter can
+        # reorder the rows, so remember which original row is edited.
+        orig_idx = model.original_index(row)
+        data = model.get_row(row)
         source_text = data[2]
         dest_text = data[3]
         dialog = EditDialog(source_text, dest_text, self)
         if dialog.exec_() == QDialog.Accepted:
             new_translation = dialog.get_translated_text()
-            self.model.set_translation(row, new_translation)
+            model.set_translation(orig_idx, new_translation)
             self.can_save = True
             self.setWindowTitle(f"Bundle Editor - {self.current_file} *")
             self.update_stats()
 
     def save_csv(self):
-        self.table.setEnabled(False)
-        self.save_action.setEnabled(False)
         if not self.model or not self.current_file:
             return
-        with open(self.current_file, "w", newline="", encoding="utf-8") as f:
-            writer = csv.writer(f)
-            writer.writerow(RAW_HEADERS)
-            for row in self.model.original_data:
-                writer.writerow(row)
+        # Prompts can request a save while one is still writing; let it
+        # finish so two writers never share the file.
+        if self.saver_thread and self.saver_thread.isRunning():
+            self.saver_thread.wait()
+        self.finish_populate()
+        self.table.setEnabled(False)
+        self.save_action.setEnabled(False)
+        self.saver_thread = CSVSaverThread(
+            self.current_file, RAW_HEADERS, self.model.original_data
+        )
+        self.saver_thread.saved.connect(self.on_csv_saved)
+        self.saver_thread.start()
+
+    def wait_saved(self):
+        if self.saver_thread:
+            self.saver_thread.wait()
+
+    def on_csv_saved(self):
         self.table.setEnabled(True)
         self.save_action.setEnabled(True)
         self.can_save = False
@@ -466,12 +675,15 @@ class CSVEditor(QMainWindow):
 
             if reply == QMessageBox.Yes:
                 self.save_csv()
+                self.wait_saved()
                 event.accept()
             elif reply == QMessageBox.Abort:
+                self.wait_saved()
                 event.accept()
             else:
                 event.ignore()
         else:
+            self.wait_saved()
             event.accept()
 
 